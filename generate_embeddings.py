@@ -1,10 +1,18 @@
 import pypdf # type: ignore
 import os
+import asyncio
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
 from dotenv import load_dotenv
-from langchain.text_splitter import RecursiveCharacterTextSplitter # type: ignore
-from openai import OpenAI # type: ignore
-import time
-import pickle
+from openai import AsyncOpenAI, BadRequestError # type: ignore
+import tiktoken # type: ignore
+import numpy as np
+import pyarrow as pa # type: ignore
+import pyarrow.feather as feather # type: ignore
+from qdrant_client import QdrantClient # type: ignore
+from vector_store import (collection_name, create_collection, load_data_from_cache,
+                          qdrant_grpc_port, qdrant_host, qdrant_port)
 
 
 # Load environment variables (if you store the PDF path there, otherwise adjust)
@@ -12,10 +20,20 @@ load_dotenv()
 
 # --- Configuration ---
 pdf_path = "detect_errors.pdf" # Or get it from config/env
-pickle_file_path = "pdf_embeddings_cache.pkl"
+cache_file_path = "pdf_embeddings_cache.arrow"
 
-chunk_size = 1000
-chunk_overlap = 150 # Overlap helps maintain context between chunks
+chunk_size = 500 # In tokens of the embedding model
+chunk_overlap = 75 # Overlap helps maintain context between chunks
+
+embedding_model = "text-embedding-3-small"
+max_batch_tokens = 250_000 # Token budget per embeddings request, under the API's 300k cap
+max_batch_items = 2048 # Max inputs per embeddings request (API limit)
+max_concurrent_requests = 8 # Embedding requests in flight at once (rate limit headroom)
+
+# Streaming ingest embeds and uploads straight to Qdrant, skipping the cache file
+streaming_ingest = os.getenv("STREAMING_INGEST", "false").lower() == "true"
+pipeline_queue_size = 4 # Batches buffered between pipeline stages
+upload_batch_size = 256 # Points per Qdrant upload
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
@@ -23,22 +41,35 @@ openai_api_key = os.getenv("OPENAI_API_KEY")
 
 # --------------- LOGIC ---------------
 # --------------- PDF Loading Logic ---------------
+@lru_cache(maxsize=None)
+def _open_pdf(file_path):
+    """Opens a PdfReader once per worker process."""
+    return pypdf.PdfReader(file_path)
+
+def _extract_page(file_path, page_num):
+    """Extracts the text of a single page. Runs in a worker process."""
+    try:
+        return page_num, _open_pdf(file_path).pages[page_num].extract_text()
+    except Exception as e:
+        print(f"Error extracting text from page {page_num + 1}: {e}")
+        return page_num, None
+
 def load_pdf_text(file_path):
-    """Loads text content from a PDF file."""
-    text = ""
+    """Loads text content from a PDF file, extracting pages in parallel."""
     try:
         reader = pypdf.PdfReader(file_path)
+        num_pages = len(reader.pages)
         print(f"Loading PDF: {file_path}")
-        print(f"Number of pages: {len(reader.pages)}")
-        for page_num, page in enumerate(reader.pages):
-            try:
-                page_text = page.extract_text()
-                if page_text: # Ensure text was extracted
-                    text += page_text + "\n" # Add newline as page separator
-                else:
-                    print(f"Warning: No text extracted from page {page_num + 1}")
-            except Exception as e:
-                print(f"Error extracting text from page {page_num + 1}: {e}")
+        print(f"Number of pages: {num_pages}")
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, 8)) as executor:
+            results = executor.map(partial(_extract_page, file_path), range(num_pages), chunksize=4)
+            pages = sorted(results)
+        text = ""
+        for page_num, page_text in pages:
+            if page_text: # Ensure text was extracted
+                text += page_text + "\n" # Add newline as page separator
+            else:
+                print(f"Warning: No text extracted from page {page_num + 1}")
         print("PDF loaded successfully.")
         return text
     except FileNotFoundError:
@@ -49,116 +80,361 @@ def load_pdf_text(file_path):
         return None
     
 # --------------- Chunking Logic ---------------
+def _is_char_boundary(encoding, tokens, i):
+    """True if the token list can be cut before tokens[i] without splitting a UTF-8 character."""
+    if i <= 0 or i >= len(tokens):
+        return True
+    first_byte = encoding.decode_single_token_bytes(tokens[i])[0]
+    return not 0x80 <= first_byte <= 0xBF # Continuation bytes never start a character
+
 def chunk_text(text, size, overlap):
-    """Splits text into chunks using RecursiveCharacterTextSplitter."""
+    """Splits text into overlapping windows of about `size` tokens using the embedding model's tokenizer.
+
+    Window edges are moved to the nearest token that starts a character, since
+    byte-level BPE can split a multi-byte character across tokens.
+    """
     if not text:
         print("Error: No text provided for chunking.")
         return []
-    print(f"Chunking text with chunk_size={size}, chunk_overlap={overlap}...")
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=size,
-        chunk_overlap=overlap,
-        length_function=len,
-        add_start_index=True, # Useful for potential source tracking later
-    )
-    # Langchain's split_text returns Document objects by default if input is a single string.
-    # To get just the text chunks (strings), we use create_documents which returns Document objs, 
-    # then extract page_content. Or simply use text_splitter.split_text directly.
-    chunks = text_splitter.split_text(text)
+    if size <= overlap:
+        print(f"Error: chunk_size ({size}) must be larger than chunk_overlap ({overlap}).")
+        return []
+    print(f"Chunking text with chunk_size={size} tokens, chunk_overlap={overlap} tokens...")
+    encoding = tiktoken.encoding_for_model(embedding_model)
+    # Special-token literals such as <|endoftext|> are ordinary text in a PDF
+    tokens = encoding.encode(text, disallowed_special=())
+
+    chunks = []
+    start = 0
+    while True:
+        end = min(start + size, len(tokens))
+        while end - 1 > start and not _is_char_boundary(encoding, tokens, end):
+            end -= 1
+        chunks.append(encoding.decode(tokens[start:end]))
+        if end == len(tokens):
+            break
+        # The next window starts `overlap` tokens back, but always moves forward
+        start = max(end - overlap, start + 1)
+        while start < end and not _is_char_boundary(encoding, tokens, start):
+            start += 1
     print(f"Successfully split text into {len(chunks)} chunks.")
     return chunks
 
 # --------------- Embedding Logic ---------------
+def batch_inputs(chunks, max_tokens=max_batch_tokens, max_items=max_batch_items, token_counts=None):
+    """Packs chunks into batches bounded by a token budget and an item count.
+
+    Pass token_counts (one per chunk) to reuse counts that were already computed.
+    """
+    if token_counts is None:
+        encoding = tiktoken.encoding_for_model(embedding_model)
+        token_counts = [len(encoding.encode(chunk, disallowed_special=())) for chunk in chunks]
+    batch = []
+    batch_tokens = 0
+    for chunk, num_tokens in zip(chunks, token_counts):
+        if batch and (batch_tokens + num_tokens > max_tokens or len(batch) >= max_items):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += num_tokens
+    if batch:
+        yield batch
+
+async def _embed_batch(client, batch, model):
+    """Embeds one batch, returning embeddings in input order.
+
+    A batch the API rejects as too long is split in half and each half retried.
+    """
+    try:
+        # The client retries rate-limited (429) requests with exponential backoff
+        response = await client.embeddings.create(input=batch, model=model)
+    except BadRequestError as e:
+        if e.code != "context_length_exceeded" or len(batch) == 1:
+            raise
+        mid = len(batch) // 2
+        return await _embed_batch(client, batch[:mid], model) + await _embed_batch(client, batch[mid:], model)
+    batch_embeddings = [None] * len(batch)
+    for item in response.data:
+        batch_embeddings[item.index] = item.embedding # Keep input order
+    return batch_embeddings
+
+async def embed_batches(batches, model):
+    """Embeds all batches concurrently, bounded by max_concurrent_requests.
+
+    Returns one entry per batch: its list of embeddings, or the exception it raised.
+    """
+    client = AsyncOpenAI()
+    sem = asyncio.Semaphore(max_concurrent_requests)
+
+    async def embed_one(batch_num, batch):
+        async with sem:
+            batch_embeddings = await _embed_batch(client, batch, model)
+        print(f"Generated embeddings for batch {batch_num+1}/{len(batches)} ({len(batch)} chunks)")
+        return batch_embeddings
+
+    results = await asyncio.gather(*[embed_one(i, b) for i, b in enumerate(batches)], return_exceptions=True)
+    await client.close()
+    return results
+
 def generate_embeddings(chunks, model):
-    """Generates embeddings for a list of text chunks using OpenAI."""
+    """Generates embeddings for a list of text chunks using OpenAI, batches sent concurrently."""
     if not chunks:
         print("No chunks provided for embedding.")
         return []
 
     print(f'\n\n---------------------------- Embedding ----------------------------')
     print(f"Generating embeddings for {len(chunks)} chunks using model '{model}'...")
-    embeddings = []
-    # Consider adding batching for efficiency if you have many chunks
-    for i, chunk in enumerate(chunks):
-        try:
-            response = client.embeddings.create(input=chunk, model=model)
-            embeddings.append(response.data[0].embedding)
-            print(f"Generated embedding for chunk {i+1}/{len(chunks)}")
-            # Add a small delay to avoid hitting rate limits aggressively
-            time.sleep(0.1)
-        except Exception as e:
-            print(f"Error generating embedding for chunk {i+1}: {e}")
-            # Decide how to handle errors: skip chunk, retry, stop?
-            embeddings.append(None) # Placeholder for failed embedding
+    # Sort by token count so each batch holds similarly sized chunks; billing and latency follow tokens
+    encoding = tiktoken.encoding_for_model(model)
+    token_counts = [len(tokens) for tokens in encoding.encode_batch(chunks, disallowed_special=())]
+    order = np.argsort(token_counts, kind="stable")
+    batches = list(batch_inputs(
+        [chunks[i] for i in order],
+        token_counts=[token_counts[i] for i in order]
+    ))
+    results = asyncio.run(embed_batches(batches, model))
+
+    sorted_embeddings = []
+    for batch_num, (batch, result) in enumerate(zip(batches, results)):
+        if isinstance(result, Exception):
+            print(f"Error generating embeddings for batch {batch_num+1}: {result}")
+            sorted_embeddings.extend([None] * len(batch)) # Placeholders for the failed batch
+        else:
+            sorted_embeddings.extend(result)
+
+    # Restore the original chunk order
+    embeddings = [None] * len(chunks)
+    for sorted_pos, chunk_idx in enumerate(order):
+        embeddings[chunk_idx] = sorted_embeddings[sorted_pos]
     print("Embedding generation complete.")
     return embeddings
 
-# --------------- Pickling ---------------
-def save_data_to_pickle(data, file_path):
-    """Saves the processed data (chunks and embeddings) to a pickle file."""
-    if not data:
+# --------------- Streaming Ingest ---------------
+async def stream_to_qdrant(chunks, model):
+    """Embeds chunks and uploads them to Qdrant as one pipeline.
+
+    Batching, embedding and uploading run as concurrent stages joined by bounded
+    queues, so wall time tracks the slowest stage and memory stays bounded by the
+    queue sizes. Point IDs are chunk indices, as in vector_store.py.
+    Returns the number of points uploaded.
+    """
+    batch_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+    result_queue = asyncio.Queue(maxsize=pipeline_queue_size)
+    openai_client = AsyncOpenAI()
+    qdrant_client = QdrantClient(host=qdrant_host, port=qdrant_port, grpc_port=qdrant_grpc_port, prefer_grpc=True)
+
+    async def produce_batches():
+        start = 0
+        for batch in batch_inputs(chunks):
+            await batch_queue.put((start, batch))
+            start += len(batch)
+        for _ in range(max_concurrent_requests):
+            await batch_queue.put(None) # One stop signal per embed worker
+
+    async def embed_worker():
+        while (item := await batch_queue.get()) is not None:
+            start, batch = item
+            try:
+                batch_embeddings = await _embed_batch(openai_client, batch, model)
+            except Exception as e:
+                print(f"Error generating embeddings for chunks {start+1}-{start+len(batch)}: {e}")
+                continue
+            print(f"Generated embeddings for chunks {start+1}-{start+len(batch)}/{len(chunks)}")
+            await result_queue.put((start, batch, batch_embeddings))
+
+    async def upload_results():
+        ids, vectors, payloads = [], [], []
+        uploaded = 0
+        collection_ready = False
+
+        async def flush():
+            nonlocal ids, vectors, payloads, uploaded
+            await asyncio.to_thread(
+                qdrant_client.upload_collection,
+                collection_name=collection_name,
+                vectors=vectors,
+                payload=payloads,
+                ids=ids,
+                batch_size=upload_batch_size
+            )
+            uploaded += len(ids)
+            print(f"Uploaded {uploaded} points to '{collection_name}'")
+            ids, vectors, payloads = [], [], []
+
+        while (item := await result_queue.get()) is not None:
+            start, batch, batch_embeddings = item
+            if not collection_ready:
+                # The vector dimension is only known once the first batch is embedded
+                if not await asyncio.to_thread(create_collection, qdrant_client, len(batch_embeddings[0])):
+                    raise RuntimeError(f"Qdrant collection '{collection_name}' is not usable.")
+                collection_ready = True
+            for offset, (text, embedding) in enumerate(zip(batch, batch_embeddings)):
+                ids.append(start + offset)
+                vectors.append(embedding)
+                payloads.append({"text": text})
+            if len(ids) >= upload_batch_size:
+                await flush()
+        if ids:
+            await flush()
+        return uploaded
+
+    uploader = asyncio.create_task(upload_results())
+    producers = asyncio.ensure_future(
+        asyncio.gather(produce_batches(), *[embed_worker() for _ in range(max_concurrent_requests)])
+    )
+    stop_signal = None
+    try:
+        # If either side fails first, stop the other rather than leave it blocked on a full queue
+        await asyncio.wait([producers, uploader], return_when=asyncio.FIRST_COMPLETED)
+        if uploader.done():
+            uploader.result() # Only finishes early by raising
+        await producers
+        # The queue may still be full, so the stop signal can only land while the uploader is running
+        stop_signal = asyncio.ensure_future(result_queue.put(None))
+        await asyncio.wait([stop_signal, uploader], return_when=asyncio.FIRST_COMPLETED)
+        return await uploader
+    finally:
+        pending = [producers, uploader] + ([stop_signal] if stop_signal else [])
+        for task in pending:
+            task.cancel()
+        # Collect the outcomes so cancelled or failed stages are not reported as unretrieved
+        await asyncio.gather(*pending, return_exceptions=True)
+        await openai_client.close()
+        qdrant_client.close()
+
+# --------------- Caching ---------------
+def chunk_hash(chunk):
+    """Returns the SHA-256 digest of a chunk, its key in the embeddings cache."""
+    return hashlib.sha256(chunk.encode()).digest()
+
+def load_cached_embeddings(file_path, model):
+    """Maps chunk hash to embedding for every chunk in an existing cache file.
+
+    Returns an empty dict if there is no cache yet, it predates chunk hashes,
+    or it was built with a different embedding model.
+    """
+    if not os.path.exists(file_path):
+        return {}
+    cached_data, _ = load_data_from_cache(file_path, with_hashes=True)
+    if not cached_data or cached_data['hashes'] is None:
+        return {}
+    if cached_data['model'] != model:
+        print(f"Ignoring cached embeddings from model '{cached_data['model']}'; current model is '{model}'.")
+        return {}
+    # Copy out of the memory-mapped file, which is rewritten at the end of the run
+    embeddings = cached_data['embeddings'].astype(np.float32)
+    return dict(zip(cached_data['hashes'], embeddings))
+
+def save_data_to_cache(data, file_path):
+    """Saves the processed data (texts, chunk hashes and embedding matrix) to an Arrow IPC (Feather) file.
+
+    Texts go in a string column, SHA-256 chunk hashes in a binary(32) column and embeddings
+    in a FixedSizeList<float16, dim> column, so readers can memory-map the file and page
+    vectors in on demand. The embedding model is recorded in the schema metadata.
+    Float16 halves the file versus float32 with negligible recall loss; readers upcast.
+    """
+    if not data or not data["texts"]:
         print("No processed data to save.")
         return False
 
     print(f"\nAttempting to save processed data to: {file_path}")
     try:
-        with open(file_path, 'wb') as f: # Open in binary write mode
-            pickle.dump(data, f)
-        print(f"Successfully saved {len(data)} items to {file_path}")
+        embeddings = data["embeddings"].astype(np.float16)
+        table = pa.Table.from_arrays(
+            [
+                pa.array(data["texts"], type=pa.string()),
+                pa.array(data["hashes"], type=pa.binary(32)),
+                pa.FixedSizeListArray.from_arrays(pa.array(embeddings.reshape(-1)), embeddings.shape[1])
+            ],
+            names=["text", "sha256", "embedding"]
+        ).replace_schema_metadata({"embedding_model": data["model"]})
+        # Uncompressed and written as one record batch, so readers can memory-map it without copies
+        feather.write_feather(table, file_path, compression="uncompressed", chunksize=max(table.num_rows, 1))
+        print(f"Successfully saved {len(data['texts'])} items to {file_path}")
         return True
     except Exception as e:
-        print(f"Error saving data to pickle file: {e}")
+        print(f"Error saving data to cache file: {e}")
         return False
 
 
 
 # --------------- Execution ---------------
-if not os.path.exists(pdf_path):
-   print(f"Error: The file '{pdf_path}' does not exist. Please check the path.")
-   # Exit or handle this error appropriately
-   exit()
-
-full_pdf_text = load_pdf_text(pdf_path)
-
-if full_pdf_text:
-    print(f'\n\n---------------------------- PDF Load ----------------------------')
-    print(f"Successfully extracted {len(full_pdf_text)} characters from the PDF.")
-
-if full_pdf_text: # Only chunk if text extraction was successful
-    text_chunks = chunk_text(full_pdf_text, chunk_size, chunk_overlap)
-    if text_chunks:
-        print(f'\n\n---------------------------- Chunking ----------------------------')
-        print(f"Example chunk (first 100 chars): {text_chunks[0][:100]}...")
-        # You now have a list of text chunks in the 'text_chunks' variable
-    else:
-        print("Chunking resulted in no chunks.")
+if __name__ == "__main__":
+    if not os.path.exists(pdf_path):
+       print(f"Error: The file '{pdf_path}' does not exist. Please check the path.")
+       # Exit or handle this error appropriately
+       exit()
 
+    full_pdf_text = load_pdf_text(pdf_path)
 
-embedding_model = "text-embedding-3-small"
-client = OpenAI()
-chunk_embeddings = []
-if 'text_chunks' in locals() and text_chunks: # Check if chunking was successful
-    chunk_embeddings = generate_embeddings(text_chunks, embedding_model)
-    if chunk_embeddings:
-       # Filter out potential None values if errors occurred
-       valid_embeddings = [emb for emb in chunk_embeddings if emb is not None]
-       print(f"Successfully generated {len(valid_embeddings)} embeddings.")
-       # print(f"Dimension of first embedding: {len(chunk_embeddings[0])}")
-    else:
-       print("Embedding generation failed or yielded no results.")
-
-processed_data = []
-if 'text_chunks' in locals() and text_chunks and chunk_embeddings and len(text_chunks) == len(chunk_embeddings):
-   for text, embedding in zip(text_chunks, chunk_embeddings):
-       if embedding: # Only include if embedding was successful
-           processed_data.append({"text": text, "embedding": embedding})
-   print(f"Created processed data structure with {len(processed_data)} items.")
-else:
-   print("Could not combine chunks and embeddings due to previous errors or mismatches.")
-
-if 'processed_data' in locals() and processed_data:
-    save_successful = save_data_to_pickle(processed_data, pickle_file_path)
-    if save_successful:
-        print("Data saved. You can load this next time instead of reprocessing the PDF.")
+    if full_pdf_text:
+        print(f'\n\n---------------------------- PDF Load ----------------------------')
+        print(f"Successfully extracted {len(full_pdf_text)} characters from the PDF.")
+
+    if full_pdf_text: # Only chunk if text extraction was successful
+        text_chunks = chunk_text(full_pdf_text, chunk_size, chunk_overlap)
+        if text_chunks:
+            print(f'\n\n---------------------------- Chunking ----------------------------')
+            print(f"Example chunk (first 100 chars): {text_chunks[0][:100]}...")
+            # You now have a list of text chunks in the 'text_chunks' variable
+        else:
+            print("Chunking resulted in no chunks.")
+
+
+    if streaming_ingest and 'text_chunks' in locals() and text_chunks:
+        print(f'\n\n---------------------------- Streaming Ingest ----------------------------')
+        try:
+            num_uploaded = asyncio.run(stream_to_qdrant(text_chunks, embedding_model))
+            print(f"Streamed {num_uploaded}/{len(text_chunks)} chunks into Qdrant collection '{collection_name}'.")
+        except Exception as e:
+            print(f"Error during streaming ingest: {e}")
+        exit()
+
+    chunk_embeddings = []
+    if 'text_chunks' in locals() and text_chunks: # Check if chunking was successful
+        # Only embed chunks whose content is not already in the cache
+        chunk_hashes = [chunk_hash(chunk) for chunk in text_chunks]
+        cached_embeddings = load_cached_embeddings(cache_file_path, embedding_model)
+        chunk_embeddings = [cached_embeddings.get(h) for h in chunk_hashes]
+        miss_indices = [i for i, embedding in enumerate(chunk_embeddings) if embedding is None]
+        print(f"Found {len(text_chunks) - len(miss_indices)}/{len(text_chunks)} chunks in the embeddings cache.")
+        if miss_indices:
+            new_embeddings = generate_embeddings([text_chunks[i] for i in miss_indices], embedding_model)
+            for i, embedding in zip(miss_indices, new_embeddings):
+                chunk_embeddings[i] = embedding
+        if chunk_embeddings:
+           # Filter out potential None values if errors occurred
+           valid_embeddings = [emb for emb in chunk_embeddings if emb is not None]
+           print(f"Successfully generated {len(valid_embeddings)} embeddings.")
+           # print(f"Dimension of first embedding: {len(chunk_embeddings[0])}")
+        else:
+           print("Embedding generation failed or yielded no results.")
+
+    processed_data = None
+    if 'text_chunks' in locals() and text_chunks and chunk_embeddings and len(text_chunks) == len(chunk_embeddings):
+       texts = []
+       hashes = []
+       embeddings = []
+       for text, h, embedding in zip(text_chunks, chunk_hashes, chunk_embeddings):
+           if embedding is not None: # Only include if embedding was successful
+               texts.append(text)
+               hashes.append(h)
+               embeddings.append(embedding)
+       # Texts, their hashes and a contiguous (N, dim) float32 matrix, row i belonging to texts[i]
+       processed_data = {
+           "texts": texts,
+           "hashes": hashes,
+           "embeddings": np.asarray(embeddings, dtype=np.float32),
+           "model": embedding_model
+       }
+       print(f"Created processed data structure with {len(texts)} items.")
     else:
-        print("Failed to save data to pickle file.")
\ No newline at end of file
+       print("Could not combine chunks and embeddings due to previous errors or mismatches.")
+
+    if processed_data:
+        save_successful = save_data_to_cache(processed_data, cache_file_path)
+        if save_successful:
+            print("Data saved. You can load this next time instead of reprocessing the PDF.")
+        else:
+            print("Failed to save data to cache file.")
\ No newline at end of file
@@ -1,18 +1,21 @@
 import os
+import asyncio
+from typing import AsyncIterator, Iterator
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from composio_openai import ComposioToolSet
-from retrieval import retrieve_relevant_chunks
+from retrieval import aretrieve_relevant_chunks, retrieve_relevant_chunks
 
 # Load environment variables
 load_dotenv()
 
-# Initialize OpenAI client
+# Initialize OpenAI clients (sync for generate_answer, async for agenerate_answer)
 openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
     print("Error: OPENAI_API_KEY not found.")
     exit()
 openai_client = OpenAI(api_key=openai_api_key)
+async_openai_client = AsyncOpenAI(api_key=openai_api_key)
 
 # Initialize Composio toolset (optional tools can be added later)
 composio_api_key = os.getenv("COMPOSIO_API_KEY")
@@ -21,28 +24,16 @@ if not composio_api_key:
     exit()
 toolset = ComposioToolSet(api_key=composio_api_key)
 
-def generate_answer(query: str, top_k: int = 3) -> str:
-    """
-    Generates an answer to the query based solely on the retrieved context.
-
-    Args:
-        query: The user's query string.
-        top_k: Number of top relevant chunks to retrieve (default is 3).
-
-    Returns:
-        A string containing the answer or an error message.
-    """
-    try:
-        # Retrieve relevant chunks from Qdrant via retrieval.py
-        retrieved_results = retrieve_relevant_chunks(query_text=query, top_k=top_k)
-        if not retrieved_results:
-            return "No relevant information found in the context."
+# Retrieval sources queried concurrently for every question
+retrieval_sources = [aretrieve_relevant_chunks]
 
-        # Concatenate retrieved chunk texts into a single context string
-        context_string = "\n\n".join([result["text"] for result in retrieved_results])
+def _build_messages(query: str, retrieved_results: list[dict]) -> list[dict]:
+    """Builds the chat messages asking for an answer based only on the retrieved chunks."""
+    # Concatenate retrieved chunk texts into a single context string
+    context_string = "\n\n".join([result["text"] for result in retrieved_results])
 
-        # Construct the prompt as specified
-        prompt = f"""
+    # Construct the prompt as specified
+    prompt = f"""
         You are an assistant designed to answer questions based ONLY on the provided context below.
         Read the context carefully.
         Answer the user's question using only the information given in the context.
@@ -58,25 +49,88 @@ def generate_answer(query: str, top_k: int = 3) -> str:
 
         Answer based solely on the context:
         """
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": prompt}
+    ]
+
+def generate_answer(query: str, top_k: int = 3) -> Iterator[str]:
+    """
+    Streams an answer to the query based solely on the retrieved context.
+
+    Args:
+        query: The user's query string.
+        top_k: Number of top relevant chunks to retrieve (default is 3).
+
+    Yields:
+        Pieces of the answer as they arrive, or an error message.
+    """
+    try:
+        # Retrieve relevant chunks from Qdrant via retrieval.py
+        retrieved_results = retrieve_relevant_chunks(query_text=query, top_k=top_k)
+        if not retrieved_results:
+            yield "No relevant information found in the context."
+            return
+
+        # Generate answer using OpenAI ChatGPT; the first token arrives long before the full completion
+        stream = openai_client.chat.completions.create(
+            model="gpt-4o",
+            messages=_build_messages(query, retrieved_results),
+            temperature=0.0,
+            stream=True
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+    except Exception as e:
+        print(f"Error generating answer: {e}")
+        yield "An error occurred while generating the answer."
+
+async def agenerate_answer(query: str, top_k: int = 3) -> AsyncIterator[str]:
+    """
+    Async counterpart of generate_answer that queries all retrieval sources concurrently.
+
+    Args:
+        query: The user's query string.
+        top_k: Number of top relevant chunks to retrieve (default is 3).
+
+    Yields:
+        Pieces of the answer as they arrive, or an error message.
+    """
+    try:
+        # Query every retrieval source at once, so latency is the slowest source rather than the sum
+        results_per_source = await asyncio.gather(
+            *[source(query_text=query, top_k=top_k) for source in retrieval_sources]
+        )
+        retrieved_results = sorted(
+            [result for results in results_per_source for result in results],
+            key=lambda result: result["score"],
+            reverse=True
+        )[:top_k]
+        if not retrieved_results:
+            yield "No relevant information found in the context."
+            return
 
-        # Generate answer using OpenAI ChatGPT
-        response = openai_client.chat.completions.create(
+        # Generate answer using OpenAI ChatGPT, streaming tokens as they arrive
+        stream = await async_openai_client.chat.completions.create(
             model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.0
+            messages=_build_messages(query, retrieved_results),
+            temperature=0.0,
+            stream=True
         )
-        answer = response.choices[0].message.content.strip()
-        return answer
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
 
     except Exception as e:
         print(f"Error generating answer: {e}")
-        return "An error occurred while generating the answer."
+        yield "An error occurred while generating the answer."
 
 # Example usage
 if __name__ == "__main__":
     sample_query = "How many samples are there in DeltaBench?"
-    result = generate_answer(sample_query)
-    print(f"Query: {sample_query}\nAnswer: {result}")
\ No newline at end of file
+    print(f"Query: {sample_query}\nAnswer: ", end="")
+    for token in generate_answer(sample_query):
+        print(token, end="", flush=True)
+    print()
@@ -1,7 +1,11 @@
 import os
+import asyncio
+from functools import lru_cache
+import numpy as np
 from dotenv import load_dotenv
-from qdrant_client import QdrantClient, models # type: ignore
+from qdrant_client import AsyncQdrantClient, QdrantClient, models # type: ignore
 from openai import OpenAI # type: ignore
+from vector_store import cache_file_path, load_data_from_cache
 
 # --- Configuration ---
 load_dotenv()
@@ -10,6 +14,11 @@ qdrant_port = int(os.getenv("QDRANT_PORT", 6333))
 collection_name = "cosmo_challenge" # MUST match the collection name used in vector_store.py
 embedding_model = "text-embedding-3-small" # MUST match the model used for initial embeddings
 
+# Search the int8 quantized index, then rescore the oversampled candidates with full-precision vectors
+search_params = models.SearchParams(
+    quantization=models.QuantizationSearchParams(rescore=True, oversampling=2.0)
+)
+
 # --- Initialize OpenAI Client ---
 openai_api_key = os.getenv("OPENAI_API_KEY")
 if not openai_api_key:
@@ -18,14 +27,88 @@ if not openai_api_key:
 openai_client = OpenAI()
 
 # --- Initialize Qdrant Client ---
+qdrant_client = None
+async_qdrant_client = None
 try:
     qdrant_client = QdrantClient(host=qdrant_host, port=qdrant_port)
     qdrant_client.get_collection(collection_name=collection_name)
+    async_qdrant_client = AsyncQdrantClient(host=qdrant_host, port=qdrant_port)
     print(f"Connected to Qdrant and collection '{collection_name}' found.")
 except Exception as e:
+    qdrant_client = None
     print(f"Error connecting to Qdrant or finding collection '{collection_name}': {e}")
-    print("Please ensure Qdrant is running and vector_store.py was executed successfully.")
-    exit()
+    print("Falling back to in-process search over the local embeddings cache.")
+
+# --- In-Process Fallback Index ---
+# For caches of this size a single matrix-vector product is often faster than a Qdrant round-trip
+if qdrant_client is None:
+    cached_data, _ = load_data_from_cache(cache_file_path)
+    if not cached_data:
+        print("Please ensure Qdrant is running and vector_store.py was executed successfully.")
+        exit()
+    fallback_texts = cached_data['texts']
+    # L2-normalized once, so a dot product with a unit query is its cosine similarity
+    fallback_embeddings = cached_data['embeddings'].astype(np.float32)
+    fallback_embeddings /= np.linalg.norm(fallback_embeddings, axis=1, keepdims=True)
+    # Symmetric per-row int8 copy for the coarse pass: row ~= fallback_i8[i] * fallback_scales[i]
+    fallback_scales = np.abs(fallback_embeddings).max(axis=1) / 127
+    fallback_i8 = np.round(fallback_embeddings / fallback_scales[:, None]).astype(np.int8)
+
+rescore_factor = 4 # Coarse int8 candidates per requested result, rescored in float32
+
+
+# --- Query Embedding ---
+@lru_cache(maxsize=1024)
+def _embed_query(text: str) -> tuple[float, ...]:
+    """Embeds the query text, caching results so repeated queries skip the API."""
+    response = openai_client.embeddings.create(
+        input=text,
+        model=embedding_model
+    )
+    return tuple(response.data[0].embedding)
+
+
+# --- Fallback Search ---
+try:
+    from numba import njit, prange # type: ignore
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _dot_i8(matrix, query, out):
+        """Integer dot product of every int8 row with the int8 query (vectorized to VNNI where available)."""
+        for i in prange(matrix.shape[0]):
+            total = 0
+            for d in range(matrix.shape[1]):
+                total += matrix[i, d] * query[d]
+            out[i] = total
+except ImportError:
+    def _dot_i8(matrix, query, out):
+        """Integer dot product of every int8 row with the int8 query."""
+        np.matmul(matrix, query, out=out, dtype=np.int32)
+
+def brute_force_search(query_embedding, top_k: int) -> list[dict]:
+    """Cosine-similarity search over the cached embeddings, best match first.
+
+    An int8 pass over every row picks top_k * rescore_factor candidates,
+    which are then rescored exactly with the float32 embeddings.
+    """
+    k = min(top_k, len(fallback_texts))
+    if k <= 0:
+        return []
+    query = np.asarray(query_embedding, dtype=np.float32)
+    query = query / np.linalg.norm(query)
+
+    # 1. Coarse int8 scores; the query's scale is shared by all rows so it can be dropped
+    query_i8 = np.round(query / (np.abs(query).max() / 127)).astype(np.int8)
+    coarse = np.empty(len(fallback_texts), dtype=np.int32)
+    _dot_i8(fallback_i8, query_i8, coarse)
+    coarse_scores = coarse * fallback_scales
+    num_candidates = min(k * rescore_factor, len(coarse_scores))
+    candidates = np.argpartition(-coarse_scores, num_candidates - 1)[:num_candidates]
+
+    # 2. Exact float32 rescoring of the candidates
+    scores = fallback_embeddings[candidates] @ query
+    best = np.argsort(-scores)[:k]
+    return [{"text": fallback_texts[candidates[i]], "score": float(scores[i])} for i in best]
 
 
 # --- Retrieval Function ---
@@ -48,12 +131,10 @@ def retrieve_relevant_chunks(query_text: str, top_k: int = 3) -> list[dict]:
 
     print(f"\nRetrieving top {top_k} relevant chunks for query: '{query_text[:50]}...'")
     try:
-        # 1. Generate query embedding
-        response = openai_client.embeddings.create(
-            input=query_text,
-            model=embedding_model
-        )
-        query_embedding = response.data[0].embedding
+        # 1. Generate query embedding (cached per query text)
+        query_embedding = list(_embed_query(query_text))
+        if qdrant_client is None:
+            return brute_force_search(query_embedding, top_k)
 
         # 2. Search Qdrant using query_points
         # query_points returns a QueryResponse object
@@ -61,6 +142,7 @@ def retrieve_relevant_chunks(query_text: str, top_k: int = 3) -> list[dict]:
             collection_name=collection_name,
             query=query_embedding,
             limit=top_k,
+            search_params=search_params,
             with_payload=True
         )
         # Access the list of points from the response object
@@ -68,17 +150,53 @@ def retrieve_relevant_chunks(query_text: str, top_k: int = 3) -> list[dict]:
         print(f"Found {len(search_points)} results from Qdrant.") # <-- Use len() on the .points attribute
 
         # 3. Extract text and score from results
-        relevant_chunks_with_scores = [
-            {"text": hit.payload['text'], "score": hit.score}
-            # Iterate over search_points (the list within the response)
-            for hit in search_points if hit.payload and 'text' in hit.payload
-        ]
-        return relevant_chunks_with_scores
+        return _points_to_chunks(search_points)
+
+    except Exception as e:
+        print(f"Error during retrieval: {e}")
+        return []
+
+async def aretrieve_relevant_chunks(query_text: str, top_k: int = 3) -> list[dict]:
+    """
+    Async counterpart of retrieve_relevant_chunks, so several retrievals can run concurrently.
+
+    Args:
+        query_text: The user's query.
+        top_k: The number of chunks to retrieve.
+
+    Returns:
+        A list of dictionaries, each containing 'text' and 'score',
+        or an empty list if an error occurs.
+    """
+    if not query_text:
+        print("Error: Query text cannot be empty.")
+        return []
+
+    try:
+        # Shares the query embedding cache; run off the event loop
+        query_embedding = list(await asyncio.to_thread(_embed_query, query_text))
+        if async_qdrant_client is None:
+            return brute_force_search(query_embedding, top_k)
+        query_response = await async_qdrant_client.query_points(
+            collection_name=collection_name,
+            query=query_embedding,
+            limit=top_k,
+            search_params=search_params,
+            with_payload=True
+        )
+        return _points_to_chunks(query_response.points)
 
     except Exception as e:
         print(f"Error during retrieval: {e}")
         return []
 
+def _points_to_chunks(search_points) -> list[dict]:
+    """Extracts text and score from Qdrant points."""
+    return [
+        {"text": hit.payload['text'], "score": hit.score}
+        for hit in search_points if hit.payload and 'text' in hit.payload
+    ]
+
 # --- Example Usage ---
 if __name__ == "__main__":
     print("\n--- Retrieval Test Script ---")
@@ -1,6 +1,5 @@
-import pickle
 import os
-import uuid
+import pyarrow.feather as feather # type: ignore
 from dotenv import load_dotenv
 from qdrant_client import QdrantClient, models
 
@@ -8,55 +7,58 @@ from qdrant_client import QdrantClient, models
 load_dotenv()
 qdrant_host = os.getenv("QDRANT_HOST", "localhost")
 qdrant_port = int(os.getenv("QDRANT_PORT", 6333))
-pickle_file_path = "pdf_embeddings_cache.pkl" # Input file
+qdrant_grpc_port = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+cache_file_path = "pdf_embeddings_cache.arrow" # Input file
 collection_name = "cosmo_challenge" # Name for the Qdrant collection
 
-print("--- Vector Store Setup Script ---")
-
 # --- Load Cached Data ---
-def load_data_from_pickle(file_path):
-    """Loads processed data (text, embedding) from a pickle file."""
+def load_data_from_cache(file_path, with_hashes=False):
+    """Loads processed data (texts, embedding matrix) from an Arrow IPC (Feather) cache file.
+
+    Chunk hashes are only converted to Python objects when with_hashes is set.
+    """
     if os.path.exists(file_path):
         print(f"\nLoading cached data from: {file_path}")
         try:
-            with open(file_path, 'rb') as f:
-                data = pickle.load(f)
-            print(f"Successfully loaded {len(data)} items from cache.")
-            if isinstance(data, list) and len(data) > 0 and 'text' in data[0] and 'embedding' in data[0]:
-                 first_embedding_dim = len(data[0]['embedding'])
-                 print(f"Detected embedding dimension: {first_embedding_dim}")
-                 return data, first_embedding_dim
+            table = feather.read_table(file_path, memory_map=True)
+            embedding_column = table.column('embedding')
+            # generate_embeddings.py writes a single chunk; combining several would copy
+            if embedding_column.num_chunks == 1:
+                embedding_array = embedding_column.chunk(0)
+            else:
+                embedding_array = embedding_column.combine_chunks()
+            data = {
+                'texts': table.column('text').to_pylist(),
+                # SHA-256 chunk hashes; None if not requested or the cache predates them
+                'hashes': table.column('sha256').to_pylist()
+                    if with_hashes and 'sha256' in table.column_names else None,
+                # Embedding model recorded by generate_embeddings.py; None for older caches
+                'model': (table.schema.metadata or {}).get(b'embedding_model', b'').decode() or None,
+                # Read-only float16 (N, dim) view over the mapped file; callers upcast as needed
+                'embeddings': embedding_array.flatten().to_numpy()
+                    .reshape(-1, embedding_array.type.list_size)
+            }
+            if len(data['texts']) == data['embeddings'].shape[0] and len(data['texts']) > 0:
+                 print(f"Successfully loaded {len(data['texts'])} items from cache.")
+                 embedding_dim = data['embeddings'].shape[1]
+                 print(f"Detected embedding dimension: {embedding_dim}")
+                 return data, embedding_dim
             else:
                  print("Error: Loaded data is not in the expected format.")
                  return None, 0
         except Exception as e:
-            print(f"Error loading data from pickle file: {e}")
+            print(f"Error loading data from cache file: {e}")
             return None, 0
     else:
         print(f"Error: Cache file not found at {file_path}. Cannot proceed.")
         return None, 0
 
-# --- Main Execution Logic ---
-if __name__ == "__main__":
-    processed_data, vector_dim = load_data_from_pickle(pickle_file_path)
-
-    if not processed_data:
-        print("Exiting script because data could not be loaded.")
-        exit()
-
-    # --- Initialize Qdrant Client ---
-    print(f"\nConnecting to Qdrant at {qdrant_host}:{qdrant_port}...")
-    try:
-        client = QdrantClient(host=qdrant_host, port=qdrant_port)
-        # Optional: Check connection/server info
-        # print(client.get_collections()) # Example check
-        print("Successfully connected to Qdrant.")
-    except Exception as e:
-        print(f"Error connecting to Qdrant: {e}")
-        print("Please ensure Qdrant is running and accessible.")
-        exit()
+# --- Create Qdrant Collection ---
+def create_collection(client, vector_dim):
+    """Creates (or recreates) the collection, falling back to an existing one of matching dimension.
 
-    # --- Create Qdrant Collection ---
+    Returns True if the collection is ready to receive points.
+    """
     try:
         print(f"\nAttempting to create or recreate collection: '{collection_name}'")
         client.recreate_collection(
@@ -64,9 +66,18 @@ if __name__ == "__main__":
             vectors_config=models.VectorParams(
                 size=vector_dim,
                 distance=models.Distance.COSINE
-            )
+            ),
+            # int8 copies of the vectors kept in RAM for search; originals are used for rescoring
+            quantization_config=models.ScalarQuantization(
+                scalar=models.ScalarQuantizationConfig(
+                    type=models.ScalarType.INT8,
+                    always_ram=True
+                )
+            ),
+            hnsw_config=models.HnswConfigDiff(m=32, ef_construct=256)
         )
         print(f"Collection '{collection_name}' created successfully.")
+        return True
     except Exception as e:
         print(f"Error creating Qdrant collection: {e}")
         # Attempt to proceed if collection might already exist correctly
@@ -74,49 +85,61 @@ if __name__ == "__main__":
              collection_info = client.get_collection(collection_name=collection_name)
              if collection_info.vectors_config.params.size != vector_dim:
                   print(f"Error: Existing collection '{collection_name}' has dimension {collection_info.vectors_config.params.size}, but data has dimension {vector_dim}.")
-                  exit()
+                  return False
              print(f"Collection '{collection_name}' already exists with correct dimension. Will upsert data.")
+             return True
         except Exception as e2:
              print(f"Could not verify existing collection: {e2}")
-             exit()
+             return False
 
+# --- Main Execution Logic ---
+if __name__ == "__main__":
+    print("--- Vector Store Setup Script ---")
+    processed_data, vector_dim = load_data_from_cache(cache_file_path)
 
-    # --- Prepare and Upsert Data into Qdrant ---
-    points_to_upsert = []
-    for i, item in enumerate(processed_data):
-         # Skip if embedding is somehow invalid (e.g., None from previous step)
-         if item.get('embedding') is None or len(item['embedding']) != vector_dim:
-              print(f"Warning: Skipping item {i} due to invalid embedding.")
-              continue
+    if not processed_data:
+        print("Exiting script because data could not be loaded.")
+        exit()
 
-         points_to_upsert.append(
-            models.PointStruct(
-                id=str(uuid.uuid4()), # Unique ID for each point
-                vector=item['embedding'],
-                payload={"text": item['text']} # Store text chunk
-            )
-        )
+    # --- Initialize Qdrant Client ---
+    print(f"\nConnecting to Qdrant at {qdrant_host}:{qdrant_grpc_port} (gRPC)...")
+    try:
+        # gRPC's binary encoding is considerably cheaper than REST/JSON for vector payloads
+        client = QdrantClient(host=qdrant_host, port=qdrant_port, grpc_port=qdrant_grpc_port, prefer_grpc=True)
+        # Optional: Check connection/server info
+        # print(client.get_collections()) # Example check
+        print("Successfully connected to Qdrant.")
+    except Exception as e:
+        print(f"Error connecting to Qdrant: {e}")
+        print("Please ensure Qdrant is running and accessible.")
+        exit()
 
-    if not points_to_upsert:
-        print("\nError: No valid points prepared for upsertion.")
+    # --- Create Qdrant Collection ---
+    if not create_collection(client, vector_dim):
         exit()
 
-    print(f"\nPreparing to upsert {len(points_to_upsert)} points into '{collection_name}'...")
 
-    # Upsert in batches
-    batch_size = 100
-    for i in range(0, len(points_to_upsert), batch_size):
-        batch = points_to_upsert[i:i + batch_size]
-        try:
-            client.upsert(
-                collection_name=collection_name,
-                points=batch,
-                wait=True # Wait for acknowledgment
-            )
-            print(f"Upserted batch {i//batch_size + 1}/{(len(points_to_upsert) + batch_size - 1)//batch_size}")
-        except Exception as e:
-            print(f"Error upserting batch starting at index {i}: {e}")
-            # Decide if you want to stop or continue on batch errors
+    # --- Upload Data into Qdrant ---
+    # Every row of the matrix has vector_dim entries, so no per-item checks are needed
+    texts = processed_data['texts']
+    embeddings = processed_data['embeddings']
+
+    print(f"\nPreparing to upload {len(texts)} points into '{collection_name}'...")
+    try:
+        # Batches are sent from parallel workers without waiting on each acknowledgment
+        client.upload_collection(
+            collection_name=collection_name,
+            # The client slices the mapped float16 matrix per batch and converts it with .tolist(),
+            # so rows are paged in on demand and never held as a full float32 copy
+            vectors=embeddings,
+            payload=({"text": text} for text in texts), # Store text chunk
+            ids=range(len(texts)), # Chunk index as ID: compact, and stable across re-ingests
+            batch_size=256,
+            parallel=4
+        )
+    except Exception as e:
+        print(f"Error uploading points: {e}")
+        exit()
 
     print("\n--- Vector Store Setup Complete ---")
     # You can verify the count in Qdrant